@@ -161,7 +161,8 @@ def is_bgzipped_and_indexed(file_path: str) -> Tuple[bool, bool]:
     Tuple[bool, bool]
         A tuple of (is_bgzipped, is_indexed) where:
         - is_bgzipped: True if the file exists and has a .gz or .bgz extension
-        - is_indexed: True if a tabix index (.tbi) file exists for this file
+        - is_indexed: True if a tabix index (.tbi or .csi) file at least as new as
+          the file itself exists (older indexes are stale)
     """
     # Check if the file exists first
     if not os.path.isfile(file_path):
@@ -170,11 +171,14 @@ def is_bgzipped_and_indexed(file_path: str) -> Tuple[bool, bool]:
     # Check if the file has a .gz or .bgz extension
     is_bgzipped = file_path.endswith('.gz') or file_path.endswith('.bgz')
     
-    # Check if a tabix index (.tbi) file exists for this file
+    # Check if an up-to-date tabix index (.tbi or .csi) file exists for this file
     is_indexed = False
     if is_bgzipped:
-        index_path = file_path + '.tbi'
-        is_indexed = os.path.isfile(index_path)
+        file_mtime = os.path.getmtime(file_path)
+        for index_path in (file_path + '.tbi', file_path + '.csi'):
+            if os.path.isfile(index_path) and os.path.getmtime(index_path) >= file_mtime:
+                is_indexed = True
+                break
     
     return is_bgzipped, is_indexed
 
@@ -6,41 +6,116 @@ This script checks if GTF and interval files are properly compressed with bgzip
 indexed with tabix. If not, it processes them accordingly. This allows for trackplot to immediately parallelise across input intervals when running the snakemake pipeline
 
 Usage:
-    python check_inputs.py -g <gtf_file> -i <intervals_file> -o <output_path>
+    python check_inputs.py -g <gtf_file> -i <intervals_file> -o <output_path> [-t <threads>] [--tmpdir <dir>]
 
 Requirements:
     - Python 3.9+
     - samtools/bgzip/tabix installed and in PATH
+    - pigz (optional) for faster decompression of non-BGZF gzipped files
+    - pysam (optional) to build tabix indexes in-process rather than calling tabix
 """
 
 import argparse
+import functools
+import gzip
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Optional, Tuple, Dict, Any
 
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+# Serialise output from concurrent workers so messages aren't interleaved
+_print_lock = threading.Lock()
+
+# Path to pigz if available, looked up on first use by _decompress_cmd
+_pigz_path: Optional[str] = None
+_pigz_checked = False
+
+def log(*args: Any, **kwargs: Any) -> None:
+    """Thread-safe wrapper around print()."""
+    with _print_lock:
+        print(*args, **kwargs)
+
 def parse_args() -> argparse.Namespace:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Check and prepare input files for Trackplot")
     parser.add_argument('-g', '--gtf', required=True, help='Path to the GTF file')
     parser.add_argument('-i', '--intervals', required=False, help='Path to the intervals.txt file')
     parser.add_argument('-o', '--output_path', default='intervals.validated.txt', help='Output path for re-processed/validated intervals.txt file')
+    parser.add_argument('--tmpdir', default=None, help='Directory for temporary files, e.g. sort spill files (default: directory of --output_path)')
+    parser.add_argument('-t', '--threads', type=int, default=os.cpu_count() or 1, help='Number of threads to use for compression (default: all available CPUs)')
     return parser.parse_args()
 
 def is_bgzipped(file_path: str) -> bool:
     """Check if a file is bgzipped by checking file extension (.gz or .bgz)."""
     return file_path.endswith('.gz') or file_path.endswith('.bgz')
 
+def resolve_path(file_path: str) -> str:
+    """
+    Normalise a path so different spellings of the same file compare equal.
+    
+    Only the parent directory is resolved (including symlinks), not the file itself,
+    as indexes and outputs are written beside the path the file is given by.
+    """
+    return os.path.join(os.path.realpath(os.path.dirname(file_path) or '.'), os.path.basename(file_path))
+
+def bgzip_output_path(file_path: str) -> str:
+    """Path of the .bgz file written when compressing (or re-compressing) a file."""
+    for ext in ('.gz', '.bgz'):
+        if file_path.endswith(ext):
+            return file_path[:-len(ext)] + '.bgz'
+    return file_path + '.bgz'
+
+def is_bgzf(file_path: str) -> bool:
+    """
+    Check if a file is actually in BGZF format (rather than e.g. plain gzip).
+    
+    Only reads the header of the first block, looking for the gzip magic bytes
+    followed by the 'BC' extra subfield that identifies BGZF blocks.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(18)
+    except OSError:
+        return False
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
 def is_tabix_indexed(file_path: str) -> bool:
-    """Check if a tabix index exists for the given file."""
-    index_path = file_path + '.tbi'
-    return os.path.exists(index_path)
+    """
+    Check if an up-to-date tabix index (.tbi or .csi) exists for the given file.
+    
+    Indexes older than the data file are treated as stale. Results are cached (by
+    resolved path) for the duration of the run.
+    """
+    return _is_tabix_indexed(resolve_path(file_path))
+
+@functools.lru_cache(maxsize=None)
+def _is_tabix_indexed(file_path: str) -> bool:
+    for ext in ('.tbi', '.csi'):
+        try:
+            index_stat = os.stat(file_path + ext)
+            data_stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        if index_stat.st_mtime >= data_stat.st_mtime:
+            return True
+    return False
 
 def check_file_status(file_path: str) -> Tuple[bool, bool]:
     """
     Check if a file is bgzipped and indexed, return status.
     
+    Results are cached by resolved path, so input files are assumed not to change
+    during a run.
+    
     Args:
         file_path: Path to the file to check
         
@@ -50,6 +125,14 @@ def check_file_status(file_path: str) -> Tuple[bool, bool]:
     Raises:
         FileNotFoundError: If the file does not exist
     """
+    try:
+        return _check_file_status(resolve_path(file_path))
+    except FileNotFoundError:
+        # Report the path as given, rather than the resolved path
+        raise FileNotFoundError(f"File not found: {file_path}") from None
+
+@functools.lru_cache(maxsize=None)
+def _check_file_status(file_path: str) -> Tuple[bool, bool]:
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
     
@@ -61,6 +144,54 @@ def check_file_status(file_path: str) -> Tuple[bool, bool]:
     
     return is_compressed, is_indexed
 
+def scan_file_statuses(file_paths: List[str]) -> Dict[str, Tuple[bool, bool]]:
+    """
+    Check the status of many files, listing each parent directory once.
+    
+    Args:
+        file_paths: Paths to the files to check
+        
+    Returns:
+        Dictionary of (is_compressed, is_indexed) tuples keyed by file path. Files
+        that do not exist are omitted
+    """
+    by_dir: Dict[str, List[str]] = {}
+    for file_path in file_paths:
+        by_dir.setdefault(os.path.dirname(file_path), []).append(file_path)
+    
+    statuses: Dict[str, Tuple[bool, bool]] = {}
+    for parent, paths in by_dir.items():
+        try:
+            with os.scandir(parent or '.') as it:
+                entries = {entry.name: entry for entry in it}
+        except OSError:
+            # Directory can't be listed - check each file individually instead
+            for file_path in paths:
+                try:
+                    statuses[file_path] = check_file_status(file_path)
+                except FileNotFoundError:
+                    pass
+            continue
+        
+        for file_path in paths:
+            name = os.path.basename(file_path)
+            entry = entries.get(name)
+            if entry is None or not entry.is_file():
+                continue
+            
+            is_compressed = is_bgzipped(file_path)
+            is_indexed = False
+            if is_compressed:
+                # Only stat files with an index present, to check the index isn't stale
+                for ext in ('.tbi', '.csi'):
+                    index_entry = entries.get(name + ext)
+                    if index_entry is not None and index_entry.stat().st_mtime >= entry.stat().st_mtime:
+                        is_indexed = True
+                        break
+            statuses[file_path] = (is_compressed, is_indexed)
+    
+    return statuses
+
 def run_command(cmd: List[str], description: str = "") -> bool:
     """
     Run a shell command and handle errors.
@@ -73,37 +204,212 @@ def run_command(cmd: List[str], description: str = "") -> bool:
         True if command succeeded, False otherwise
     """
     try:
-        print(f"Running: {' '.join(cmd)}")
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        log(f"Running: {' '.join(cmd)}")
+        # stdout is never used, so discard it rather than buffering it in memory
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         return True
     except subprocess.CalledProcessError as e:
-        print(f"Error in {description}: {e}", file=sys.stderr)
-        print(f"STDERR: {e.stderr.decode()}", file=sys.stderr)
+        log(f"Error in {description}: {e}", file=sys.stderr)
+        log(f"STDERR: {e.stderr.decode()}", file=sys.stderr)
+        return False
+    except OSError as e:
+        # e.g. the command isn't installed
+        log(f"Error in {description}: {e}", file=sys.stderr)
+        return False
+
+def run_pipeline(cmds: List[List[str]], output_path: str, description: str = "") -> bool:
+    """
+    Run a series of commands connected by pipes, writing the final output to a file.
+    
+    Args:
+        cmds: Commands to run, each as a list of strings. The stdout of each command
+              is fed to the stdin of the next
+        output_path: Path to write the stdout of the final command to
+        description: Description of the pipeline for error reporting
+        
+    Returns:
+        True if every command in the pipeline succeeded, False otherwise
+    """
+    log(f"Running: {' | '.join(' '.join(cmd) for cmd in cmds)} > {output_path}")
+    procs: List[subprocess.Popen] = []
+    started = False
+    try:
+        with open(output_path, 'wb') as out_file:
+            for i, cmd in enumerate(cmds):
+                stdin = procs[-1].stdout if procs else None
+                stdout = out_file if i == len(cmds) - 1 else subprocess.PIPE
+                procs.append(subprocess.Popen(cmd, stdin=stdin, stdout=stdout))
+                if stdin is not None:
+                    # Close our copy so upstream receives SIGPIPE if downstream exits early
+                    stdin.close()
+        started = True
+    except OSError as e:
+        # e.g. one of the commands isn't installed
+        log(f"Error in {description}: {e}", file=sys.stderr)
+        return False
+    finally:
+        # Don't leave earlier commands running if a later one failed to start
+        if not started:
+            for proc in procs:
+                if proc.stdout is not None:
+                    proc.stdout.close()
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+    
+    success = True
+    for cmd, proc in zip(cmds, procs):
+        if proc.wait() != 0:
+            log(f"Error in {description}: Command '{cmd}' returned non-zero exit status {proc.returncode}.", file=sys.stderr)
+            success = False
+    return success
+
+def _decompress_cmd(file_path: str, threads: int) -> List[str]:
+    """
+    Build a command to decompress a gzipped file to stdout.
+    
+    Uses multi-threaded pigz when available, falling back to zcat otherwise.
+    (On machines with many cores (>16), rapidgzip scales further still and could be
+    substituted here.)
+    
+    Args:
+        file_path: Path to the gzipped file
+        threads: Number of threads pigz may use
+        
+    Returns:
+        Command as a list of strings
+    """
+    global _pigz_path, _pigz_checked
+    if not _pigz_checked:
+        _pigz_path = shutil.which("pigz")
+        _pigz_checked = True
+    
+    if _pigz_path:
+        return [_pigz_path, "-dc", "-p", str(threads), file_path]
+    return ["zcat", file_path]
+
+def tabix_index(file_path: str, tabix_preset: str, description: str = "") -> bool:
+    """
+    Create a tabix index for a bgzipped file.
+    
+    Uses pysam's bindings to htslib when available to avoid spawning a process,
+    otherwise runs the tabix command line tool. Any existing (stale) indexes are
+    removed first, as htslib prefers a .csi over a .tbi and would otherwise keep
+    loading a stale .csi. If a .csi existed, the index is rebuilt as a .csi.
+    
+    Args:
+        file_path: Path to the bgzipped file to index
+        tabix_preset: Tabix preset to use ('bed' or 'gff')
+        description: Description of the step for error reporting
+        
+    Returns:
+        True if indexing succeeded, False otherwise
+    """
+    csi = os.path.exists(file_path + '.csi')
+    for ext in ('.tbi', '.csi'):
+        if os.path.exists(file_path + ext):
+            os.unlink(file_path + ext)
+    
+    if pysam is None:
+        return run_command(["tabix", "-f"] + (["-C"] if csi else []) + ["-p", tabix_preset, file_path], description)
+    
+    try:
+        log(f"Running: pysam.tabix_index({file_path}, preset={tabix_preset}, csi={csi})")
+        pysam.tabix_index(file_path, preset=tabix_preset, force=True, keep_original=True, csi=csi)
+        return True
+    except (OSError, ValueError) as e:
+        log(f"Error in {description}: {e}", file=sys.stderr)
         return False
 
 def determine_tabix_preset(file_path: str) -> str:
     """
     Determine the appropriate tabix preset based on file extension.
     
+    Only the file name's suffix (ignoring any .gz/.bgz extension) is considered, so
+    e.g. '/data/tracks.bed/annotation.gtf.gz' is correctly treated as a GFF file.
+    BED-like formats (.bed, .bed6, .bed12, .bedGraph, .narrowPeak, .broadPeak etc.)
+    are all treated as BED.
+    
     Args:
         file_path: Path to the file
         
     Returns:
         Tabix preset: 'bed' for bed files, 'gff' for others
     """
-    if ".bed" in file_path.lower():
+    name = os.path.basename(file_path).lower()
+    for ext in ('.gz', '.bgz'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    
+    suffix = os.path.splitext(name)[1]
+    if suffix.startswith('.bed') or suffix in ('.narrowpeak', '.broadpeak'):
         return "bed"
     else:
         return "gff"
 
+def is_already_sorted(file_path: str, tabix_preset: str, max_lines: Optional[int] = 100000) -> bool:
+    """
+    Check whether a file is already sorted in an order tabix can index.
+    
+    Tabix requires each chromosome to form a single contiguous block, with start
+    positions non-decreasing within each block.
+    
+    Args:
+        file_path: Path to the file to check (plain text, or gzipped if .gz/.bgz)
+        tabix_preset: Tabix preset of the file ('bed' or 'gff')
+        max_lines: Stop and optimistically report the file as sorted after this many
+                   lines. Use None to check the whole file
+        
+    Returns:
+        True if the file (or the checked portion) is sorted, False otherwise
+    """
+    start_col = 1 if tabix_preset == "bed" else 3
+    opener = gzip.open if is_bgzipped(file_path) else open
+    seen_chroms = set()
+    prev_chrom = None
+    prev_start = -1
+    
+    try:
+        with opener(file_path, 'rt') as infile:
+            for line_num, line in enumerate(infile):
+                if max_lines is not None and line_num >= max_lines:
+                    break
+                if not line.strip() or line.startswith('#'):
+                    continue
+                
+                cols = line.split('\t')
+                try:
+                    chrom, start = cols[0], int(cols[start_col])
+                except (IndexError, ValueError):
+                    return False
+                
+                if chrom != prev_chrom:
+                    if chrom in seen_chroms:
+                        return False
+                    seen_chroms.add(chrom)
+                    prev_chrom = chrom
+                elif start < prev_start:
+                    return False
+                prev_start = start
+    except (OSError, EOFError, UnicodeDecodeError):
+        return False
+    
+    return True
+
 
-def process_file(file_path: str, tabix_preset: str) -> str:
+def process_file(file_path: str, tabix_preset: str, threads: int = 1,
+                 status: Optional[Tuple[bool, bool]] = None) -> str:
     """
     Process a file: bgzip and tabix if needed.
     
     Args:
         file_path: Path to the file to process
         tabix_preset: Tabix preset to use ('bed' or 'gff')
+        threads: Number of compression threads passed to bgzip
+        status: (is_compressed, is_indexed) tuple if already known, otherwise
+                it is looked up with check_file_status
         
     Returns:
         Path to the processed file
@@ -111,18 +417,22 @@ def process_file(file_path: str, tabix_preset: str) -> str:
     Raises:
         RuntimeError: If processing fails at any step
     """
-    is_compressed, is_indexed = check_file_status(file_path)
+    is_compressed, is_indexed = status if status is not None else check_file_status(file_path)
     
     if is_compressed and is_indexed:
-        print(f"File {file_path} is already bgzipped and indexed.")
+        log(f"File {file_path} is already bgzipped and indexed.")
         return file_path
     
-    # Determine output path
-    output_path = file_path
-    if not is_compressed:
-        # For uncompressed files
-        base_path = file_path
-        output_path = base_path + '.bgz'
+    # Determine output path (uncompressed files are bgzipped alongside the original)
+    output_path = file_path if is_compressed else bgzip_output_path(file_path)
+    
+    # Reuse the output of a previous run if it's indexed and newer than the input. For
+    # compressed inputs this is the re-bgzipped copy written by the fallback below
+    cached_path = bgzip_output_path(file_path)
+    if cached_path != file_path and os.path.exists(cached_path) and is_tabix_indexed(cached_path):
+        if os.stat(cached_path).st_mtime >= os.stat(file_path).st_mtime:
+            log(f"Using cached {cached_path}")
+            return cached_path
 
     # determine sort command based on file suffix
     if tabix_preset == "bed":
@@ -132,216 +442,264 @@ def process_file(file_path: str, tabix_preset: str) -> str:
     
     # Process file if needed
     if not is_compressed:
-        # Sort and bgzip directly
-        with tempfile.NamedTemporaryFile(suffix='.sorted') as temp_file:
-            # Sort the file
-            sort_cmd = sort_cmd_prefix + ["-o", temp_file.name, file_path]
-            if not run_command(sort_cmd, f"sorting {tabix_preset} file"):
-                raise RuntimeError(f"Failed to sort file: {file_path}")
-            
-            # Bgzip the sorted file
-            bgzip_cmd = ["bgzip", "-c", temp_file.name]
-            try:
-                with open(output_path, 'wb') as out_file:
-                    subprocess.run(bgzip_cmd, check=True, stdout=out_file)
-                print(f"Created bgzipped file: {output_path}")
-            except subprocess.CalledProcessError as e:
-                raise RuntimeError(f"Failed to bgzip file {file_path}: {e}")
+        # Sort and bgzip directly, streaming sort output into bgzip. Skip sorting if the
+        # start of the file is already sorted - the fallback below re-sorts if tabix fails
+        bgzip_cmd = ["bgzip", "-@", str(threads), "-c"]
+        if is_already_sorted(file_path, tabix_preset):
+            log(f"File {file_path} is already sorted, skipping sort.")
+            cmds = [bgzip_cmd + [file_path]]
+        else:
+            cmds = [sort_cmd_prefix + [file_path], bgzip_cmd]
+        if not run_pipeline(cmds, output_path, f"sorting and bgzipping {tabix_preset} file"):
+            raise RuntimeError(f"Failed to sort and bgzip file: {file_path}")
+        log(f"Created bgzipped file: {output_path}")
     
     # At this point, we have a compressed file (either the original or newly compressed)
     
-    # First attempt to create tabix index directly
+    # First attempt to create tabix index directly, unless the input is known not to be BGZF
     if not is_indexed:
-        tabix_cmd = ["tabix", "-p", tabix_preset, output_path]
-        indexing_success = run_command(tabix_cmd, f"indexing {tabix_preset} file")
+        if is_compressed and not is_bgzf(output_path):
+            log(f"File {output_path} is not BGZF compressed, skipping direct indexing.")
+            indexing_success = False
+        else:
+            indexing_success = tabix_index(output_path, tabix_preset, f"indexing {tabix_preset} file")
+            if not indexing_success:
+                log("Direct indexing failed. The file might not be properly bgzipped.")
         
         # If indexing failed, we need to decompress and recompress
         if not indexing_success:
-            print("Direct indexing failed. The file might not be properly bgzipped. Attempting to decompress and re-bgzip...")
+            log("Attempting to decompress and re-bgzip...")
             
             # Determine new output filename for the re-bgzipped file
-            base_path = output_path
-            if base_path.endswith('.gz'):
-                base_path = base_path[:-3]  # Remove .gz extension
-            elif base_path.endswith('.bgz'):
-                base_path = base_path[:-4]  # Remove .bgz extension
-            rebgzipped_output = base_path + '.bgz'
+            rebgzipped_output = bgzip_output_path(output_path)
             
-            # First decompress to a temporary file
-            with tempfile.NamedTemporaryFile(suffix='.uncompressed', delete=False) as temp_uncompressed:
-                temp_uncompressed_path = temp_uncompressed.name
+            # Decompress, sort and re-bgzip in a single pipeline. Check the whole file here,
+            # as we may have reached this point after skipping a sort
+            if is_already_sorted(output_path, tabix_preset, max_lines=None):
+                log(f"File {output_path} is already sorted, skipping sort.")
+                # Decompression and compression then run at the same time, so split the
+                # thread budget between them. Inflating is much cheaper, so bgzip gets most
+                decompress_threads = max(1, threads // 4)
+                decompress_cmd = _decompress_cmd(output_path, decompress_threads)
+                bgzip_cmd = ["bgzip", "-@", str(max(1, threads - decompress_threads)), "-c"]
+                cmds = [decompress_cmd, bgzip_cmd]
+            else:
+                # sort reads all of its input before writing any output, so decompression
+                # and compression never overlap and can each use the full thread budget
+                decompress_cmd = _decompress_cmd(output_path, threads)
+                bgzip_cmd = ["bgzip", "-@", str(threads), "-c"]
+                cmds = [decompress_cmd, sort_cmd_prefix, bgzip_cmd]
             
-            try:
-                # Use zcat or gzip -dc to decompress
-                decompress_cmd = ["zcat", output_path]
-                try:
-                    with open(temp_uncompressed_path, 'wb') as temp_file:
-                        subprocess.run(decompress_cmd, check=True, stdout=temp_file)
-                except subprocess.CalledProcessError as e:
-                    os.unlink(temp_uncompressed_path)
-                    raise RuntimeError(f"Failed to decompress file {output_path}: {e}")
-                
-                # Sort the decompressed file
-                with tempfile.NamedTemporaryFile(suffix='.sorted', delete=False) as temp_sorted:
-                    temp_sorted_path = temp_sorted.name
-                
-                sort_cmd = sort_cmd_prefix + ["-o", temp_sorted_path, temp_uncompressed_path]
-                if not run_command(sort_cmd, f"sorting decompressed file"):
-                    os.unlink(temp_uncompressed_path)
-                    os.unlink(temp_sorted_path)
-                    raise RuntimeError(f"Failed to sort decompressed file {temp_uncompressed_path}")
-                
-                # Clean up the uncompressed file, we don't need it anymore
-                os.unlink(temp_uncompressed_path)
-                
-                # Bgzip the sorted file
-                bgzip_cmd = ["bgzip", "-c", temp_sorted_path]
-                try:
-                    with open(rebgzipped_output, 'wb') as out_file:
-                        subprocess.run(bgzip_cmd, check=True, stdout=out_file)
-                    print(f"Created properly bgzipped file at: {rebgzipped_output}")
-                except subprocess.CalledProcessError as e:
-                    os.unlink(temp_sorted_path)
-                    raise RuntimeError(f"Failed to bgzip sorted file {temp_sorted_path}: {e}")
-                
-                # Clean up the sorted file
-                os.unlink(temp_sorted_path)
-                
-                # Try tabix on the re-bgzipped file
-                tabix_cmd = ["tabix", "-p", tabix_preset, rebgzipped_output]
-                if run_command(tabix_cmd, f"indexing re-bgzipped {tabix_preset} file"):
-                    output_path = rebgzipped_output
-                    print(f"Successfully indexed re-bgzipped file: {output_path}")
-                else:
-                    raise RuntimeError(f"Failed to create tabix index even after re-bgzipping: {rebgzipped_output}")
-            except Exception as e:
-                # Clean up any temporary files
-                if os.path.exists(temp_uncompressed_path):
-                    os.unlink(temp_uncompressed_path)
-                if 'temp_sorted_path' in locals() and os.path.exists(temp_sorted_path):
-                    os.unlink(temp_sorted_path)
-                    
-                # Propagate the error
-                if isinstance(e, RuntimeError):
-                    raise
-                else:
-                    raise RuntimeError(f"Error during fallback processing of {file_path}: {e}")
+            # Write to a temporary directory first, as the re-bgzipped output may overwrite
+            # the input file. It sits beside the output so the final move is a rename, and
+            # is cleaned up automatically however we leave this block
+            output_dir = os.path.dirname(os.path.abspath(rebgzipped_output))
+            with tempfile.TemporaryDirectory(dir=output_dir) as temp_dir:
+                temp_output = os.path.join(temp_dir, os.path.basename(rebgzipped_output))
+                if not run_pipeline(cmds, temp_output, "decompressing, sorting and re-bgzipping file"):
+                    raise RuntimeError(f"Failed to decompress, sort and re-bgzip file {output_path}")
+                os.replace(temp_output, rebgzipped_output)
+            log(f"Created properly bgzipped file at: {rebgzipped_output}")
+            
+            # Try tabix on the re-bgzipped file
+            if tabix_index(rebgzipped_output, tabix_preset, f"indexing re-bgzipped {tabix_preset} file"):
+                output_path = rebgzipped_output
+                log(f"Successfully indexed re-bgzipped file: {output_path}")
+            else:
+                raise RuntimeError(f"Failed to create tabix index even after re-bgzipping: {rebgzipped_output}")
         else:
-            print(f"Successfully indexed file: {output_path}")
+            log(f"Successfully indexed file: {output_path}")
     
     return output_path
 
-def process_gtf(gtf_path: str) -> str:
+def _process_files_serially(files: List[Tuple[str, str, Tuple[bool, bool]]], threads: int = 1) -> List[str]:
     """
-    Process GTF file: check if bgzipped and tabix indexed, process if needed.
+    Process (file_path, tabix_preset, status) entries one after another.
+    
+    Used for files that share an output path, so they never write it concurrently.
     
-    Args:
-        gtf_path: Path to the GTF file
-        
     Returns:
-        Path to the processed GTF file
-        
-    Raises:
-        RuntimeError: If processing fails
-        FileNotFoundError: If the file doesn't exist
+        Paths to the processed files, in the same order as files
     """
-    try:
-        return process_file(gtf_path, "gff")
-    except RuntimeError as e:
-        print(f"Fatal error processing GTF file: {e}", file=sys.stderr)
-        raise
+    return [process_file(file_path, tabix_preset, threads, status)
+            for file_path, tabix_preset, status in files]
 
-def process_intervals_file(intervals_path: str, output_path: str) -> Optional[str]:
+def read_interval_paths(intervals_path: str) -> List[str]:
     """
-    Process intervals file, update file paths if needed, and write a new intervals file.
+    Read the file paths listed in an intervals file.
     
     Args:
         intervals_path: Path to the intervals file
-        output_dir: Output directory for processed files
         
     Returns:
-        Path to the processed intervals file, or None if no intervals file was provided
+        Unique file paths, in the order they're first listed
     """
-    if not intervals_path or not os.path.exists(intervals_path):
-        print("No intervals file provided or file not found.")
-        return None
-    
-    output_intervals = output_path
-    
-    # Read and process interval file
-    updated_lines: List[str] = []
-    updated = False
+    seen_paths: Dict[str, None] = {}
     
     with open(intervals_path, 'r') as infile:
         for line in infile:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                updated_lines.append(line)
+            if line.lstrip().startswith('#'):
                 continue
             
-            parts = line.split()
+            # Only the first field is needed, so avoid splitting the whole line
+            parts = line.split(None, 1)
             if len(parts) < 2:
-                updated_lines.append(line)  # Preserve malformed lines
                 continue
             
-            file_path = parts[0]
-            try:
-                is_compressed, is_indexed = check_file_status(file_path)
-                
-                # Process file if needed
-                if not (is_compressed and is_indexed):
-                    # Determine tabix preset based on file extension
-                    tabix_preset = determine_tabix_preset(file_path)
-                    
-                    # Process file and get new path
-                    proc_path = process_file(file_path, tabix_preset)
-                    if proc_path != file_path:
-                        updated = True
-                        parts[0] = proc_path
-            except FileNotFoundError:
-                print(f"Warning: File specified in intervals not found: {file_path}", file=sys.stderr)
-            
-            updated_lines.append('\t'.join(parts))
-    
-    # Write updated intervals file
-    if updated:
-        with open(output_intervals, 'w') as outfile:
-            for line in updated_lines:
-                outfile.write(f"{line}\n")
-        print(f"Updated intervals file saved to: {output_intervals}")
-        return output_intervals
-    else:
-        print("No updates needed for intervals file.")
+            seen_paths[parts[0]] = None
+    
+    return list(seen_paths)
+
+def process_files(files: List[Tuple[str, str]], threads: int = 1) -> Dict[str, str]:
+    """
+    Bgzip and tabix index files as needed, processing independent files concurrently.
+    
+    Compression and indexing both run outside the GIL (in subprocesses, or in htslib
+    via pysam), so a thread pool is enough to process files in parallel.
+    
+    Args:
+        files: (file_path, tabix_preset) pairs to process. Missing files are skipped
+               with a warning
+        threads: Total number of threads shared across concurrently processed files
+        
+    Returns:
+        Dictionary of processed file paths keyed by original file path, for files
+        that needed processing
+        
+    Raises:
+        RuntimeError: If processing any file fails
+    """
+    # Check all files together, so each directory is only listed once
+    statuses = scan_file_statuses([file_path for file_path, _ in files])
+    
+    # Different spellings of the same file (e.g. 'd/a.bed' and './d/a.bed') are only
+    # processed once. Files that would write the same output (e.g. 'x.gz' and 'x.bgz')
+    # are grouped, so they're processed one after another rather than concurrently
+    spellings: Dict[str, List[str]] = {}
+    presets: Dict[str, str] = {}
+    for file_path, tabix_preset in files:
+        if file_path not in statuses:
+            log(f"Warning: File not found, skipping: {file_path}", file=sys.stderr)
+            continue
+        resolved = resolve_path(file_path)
+        spellings.setdefault(resolved, []).append(file_path)
+        presets.setdefault(resolved, tabix_preset)
+    
+    tasks: Dict[str, List[Tuple[str, str, Tuple[bool, bool]]]] = {}
+    for resolved, paths in spellings.items():
+        # Process file if needed
+        is_compressed, is_indexed = statuses[paths[0]]
+        if not (is_compressed and is_indexed):
+            tasks.setdefault(bgzip_output_path(resolved), []).append(
+                (paths[0], presets[resolved], (is_compressed, is_indexed)))
+    
+    processed: Dict[str, str] = {}
+    if tasks:
+        max_workers = min(len(tasks), os.cpu_count() or 1)
+        # Split compression threads between workers to avoid oversubscription
+        task_threads = max(1, threads // max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_process_files_serially, group, task_threads): group
+                       for group in tasks.values()}
+            for future in as_completed(futures):
+                for (file_path, _, _), proc_path in zip(futures[future], future.result()):
+                    for spelling in spellings[resolve_path(file_path)]:
+                        processed[spelling] = proc_path
+    
+    return processed
+
+def write_intervals_file(intervals_path: str, output_path: str, processed: Dict[str, str]) -> str:
+    """
+    Write a new intervals file with the paths of processed files, if any changed.
+    
+    Args:
+        intervals_path: Path to the intervals file
+        output_path: Output path for the updated intervals file
+        processed: Processed file paths keyed by original path, from process_files
+        
+    Returns:
+        Path to the updated intervals file, or intervals_path if no paths changed
+    """
+    output_intervals = output_path
+    
+    if not any(proc_path != file_path for file_path, proc_path in processed.items()):
+        log("No updates needed for intervals file.")
         return intervals_path
+    
+    # Stream lines to a temporary output, updating any processed file paths
+    temp_intervals = output_intervals + '.tmp'
+    try:
+        with open(intervals_path, 'r') as infile, open(temp_intervals, 'w') as outfile:
+            for line in infile:
+                parts = line.split(None, 1)
+                if line.lstrip().startswith('#') or len(parts) < 2:
+                    outfile.write(line)  # Preserve comments, blank & malformed lines
+                    continue
+                
+                # Only rebuild lines whose path changed, keeping the original delimiters
+                file_path = parts[0]
+                proc_path = processed.get(file_path, file_path)
+                if proc_path != file_path:
+                    start = line.index(file_path)
+                    line = line[:start] + proc_path + line[start + len(file_path):]
+                
+                outfile.write(line)
+        os.replace(temp_intervals, output_intervals)
+    except BaseException:
+        if os.path.exists(temp_intervals):
+            os.unlink(temp_intervals)
+        raise
+    
+    log(f"Updated intervals file saved to: {output_intervals}")
+    return output_intervals
 
 def main() -> None:
     """Main function."""
     args = parse_args()
     
-    # Process GTF file
+    # Keep temporary files on the same filesystem as the outputs (rather than e.g. /tmp),
+    # so sort doesn't spill large inputs across filesystems. Spawned commands inherit this
+    tmpdir = args.tmpdir or os.path.dirname(os.path.abspath(args.output_path))
+    os.environ['TMPDIR'] = tmpdir
+    
+    try:
+        check_file_status(args.gtf)
+    except FileNotFoundError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    interval_paths: List[str] = []
+    has_intervals = bool(args.intervals) and os.path.exists(args.intervals)
+    if has_intervals:
+        interval_paths = read_interval_paths(args.intervals)
+    elif args.intervals:
+        print("No intervals file provided or file not found.")
+    
+    # Process the GTF together with the interval files, so it doesn't hold up the rest
+    files = [(args.gtf, "gff")] + [(file_path, determine_tabix_preset(file_path)) for file_path in interval_paths]
     try:
-        processed_gtf = process_gtf(args.gtf)
-        print(f"GTF file: {processed_gtf}")
+        processed = process_files(files, args.threads)
     except FileNotFoundError as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
-    except RuntimeError as e:
-        print(f"Error processing GTF file: {e}", file=sys.stderr)
+    except (RuntimeError, OSError) as e:
+        print(f"Error processing input files: {e}", file=sys.stderr)
         sys.exit(1)
+    print(f"GTF file: {processed.get(args.gtf, args.gtf)}")
     
-    # Process intervals file if provided
+    # Write updated intervals file if provided
     if args.intervals:
-        try:
-            processed_intervals = process_intervals_file(args.intervals, args.output_path)
-            print(f"Intervals file: {processed_intervals}")
-        except FileNotFoundError as e:
-            print(f"Error: {e}", file=sys.stderr)
-            sys.exit(1)
-        except RuntimeError as e:
-            print(f"Error processing intervals file: {e}", file=sys.stderr)
-            sys.exit(1)
+        processed_intervals = None
+        if has_intervals:
+            try:
+                interval_processed = {file_path: processed[file_path] for file_path in interval_paths if file_path in processed}
+                processed_intervals = write_intervals_file(args.intervals, args.output_path, interval_processed)
+            except OSError as e:
+                print(f"Error writing intervals file: {e}", file=sys.stderr)
+                sys.exit(1)
+        print(f"Intervals file: {processed_intervals}")
     
     print("\nAll input files have now been validated or re-processed")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()